@@ -1,101 +1,214 @@
 import requests
 import os
+import sys
+import queue
+import logging
+import logging.handlers
+import io
+import hashlib
+import contextlib
 import time
+import threading
 import concurrent.futures
+from requests.adapters import HTTPAdapter
+import urllib3.exceptions
+from urllib3.util.retry import Retry
 from PIL import Image, ImageFile, ExifTags
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # Handle truncated images
 
-def download_image(image_url, output_folder, i):
-    """Downloads a single image, handling errors and saving to disk with EXIF copyright and program name."""
-    try:
-        response = requests.get(image_url, stream=True, timeout=10)  # timeout added
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-
-        # Determine the filename from the headers, adding an index to ensure it's unique
-        # Force the extension to .webp if it's not found or incorrect
-        filename = f"image_{i}.webp"  # Default filename with index and .webp
-
-        if 'content-disposition' in response.headers:
-            content_disposition = response.headers['content-disposition']
-            filename_start = content_disposition.find("filename=")
-            if filename_start != -1:
-                filename_from_header = content_disposition[filename_start + len("filename="):].strip('"')
-                filename = f"{os.path.splitext(filename_from_header)[0]}_{i}.webp"  # Add unique index and force .webp
+logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 1 << 20  # 1MB reads keep hashlib's C code busy instead of the interpreter loop
+WRITE_BUFFER_SIZE = 1 << 21  # 2MB, most images are flushed to disk in a single write() call
+
+_thread_local = threading.local()
+
+
+def _get_session():
+    """Returns this thread's session, so every worker keeps its own warm connection without sharing a pool."""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries))
+        session.headers["Accept-Encoding"] = "identity"  # webp is already compressed, don't re-wrap the body
+        _thread_local.session = session
+    return session
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how many requests all workers together may start per second."""
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError(f"Request rate must be positive, got {rate}")
+        self.rate = rate
+        self.tokens = rate
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Blocks until a request may be made. Waiting while holding the lock queues the other workers behind."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.timestamp = time.monotonic()
+                self.tokens = 0
             else:
-                filename = f"image_{i}.webp" # Default filename if no filename found
+                self.tokens -= 1
 
-        # If the content type contains webp, keep as webp. If not, force webp by changing extension
-        content_type = response.headers.get('Content-Type', '')
-        if "image/webp" not in content_type.lower():
-            filename = f"image_{i}.webp" # Default filename if content type is not webp
 
-        file_path = os.path.join(output_folder, filename)
+def encode_with_exif(file_path, image_url):
+    """Returns the image at file_path re-encoded as webp with EXIF copyright and program name."""
+    # Open the image using Pillow
+    with Image.open(file_path) as img:
+        # Handle images without existing EXIF data
+        if 'exif' in img.info:
+            exif_data = img.info['exif']
+        else:
+            exif_data = b'EXIF\x00\x00'  # Minimal EXIF header
 
-        with open(file_path, 'wb') as out_file:
-            for chunk in response.iter_content(chunk_size=8192): # 8KB chunks
-                out_file.write(chunk)
+        # Load existing EXIF data if it exists
+        try:
+            exif = img.getexif()
+        except AttributeError:  # Handle images where getexif() fails
+            exif = {}  # Create an empty dictionary if it fails
 
-        print(f"Downloaded image {i} to {file_path}")
+        # Create a dictionary to map EXIF tag names to numeric IDs
+        exif_tags = {ExifTags.TAGS[key]: key for key in ExifTags.TAGS}
 
+        # Set the copyright tag (33432) to "pic.re"
+        exif[exif_tags['Copyright']] = image_url
 
-        # Add EXIF copyright and software data
-        try:
-            # Open the image using Pillow
-            img = Image.open(file_path)
+        # Set the software tag (305) to "Visiuun's pic.re downloader"
+        exif[exif_tags['Software']] = "Visiuun's pic.re downloader"
 
-            # Handle images without existing EXIF data
-            if 'exif' in img.info:
-                exif_data = img.info['exif']
-            else:
-                exif_data = b'EXIF\x00\x00'  # Minimal EXIF header
+        # Convert the EXIF data back to bytes
+        new_exif_bytes = img.getexif().tobytes()
 
-            # Load existing EXIF data if it exists
-            try:
-                exif = img.getexif()
-            except AttributeError:  # Handle images where getexif() fails
-                exif = {}  # Create an empty dictionary if it fails
+        # Encode the image with the new EXIF data in memory, a failed encode must not truncate the file
+        buffer = io.BytesIO()
+        img.save(buffer, "webp", exif=new_exif_bytes)
+        return buffer.getvalue()
 
-            # Create a dictionary to map EXIF tag names to numeric IDs
-            exif_tags = {ExifTags.TAGS[key]: key for key in ExifTags.TAGS}
 
-            # Set the copyright tag (33432) to "pic.re"
-            exif[exif_tags['Copyright']] = image_url
+def hash_and_write(raw, out_file, hasher, buffer_size=READ_BUFFER_SIZE):
+    """Copies a file-like object to out_file while hashing it."""
+    buffer = memoryview(bytearray(buffer_size))
+    while n := raw.readinto(buffer):
+        hasher.update(buffer[:n])
+        out_file.write(buffer[:n])
 
-            # Set the software tag (305) to "Visiuun's pic.re downloader"
-            exif[exif_tags['Software']] = "Visiuun's pic.re downloader"
 
-            # Convert the EXIF data back to bytes
-            new_exif_bytes = img.getexif().tobytes()
+def download_image(image_url, output_prefix, i, claimed_hashes, etag_cache, hashes_lock, bucket):
+    """Downloads a single image, skipping duplicates of already downloaded content, and saves it to disk as
+    <sha256>.webp with EXIF copyright and program name."""
+    try:
+        bucket.take()  # Respect the shared request rate before hitting the server
+        response = _get_session().get(image_url, stream=True, timeout=10)  # timeout added
+        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
 
-            # Save the image with the new EXIF data
-            img.save(file_path, "webp", exif=new_exif_bytes)
+        # A 200 that isn't an image (e.g. an HTML captcha page) is a failed fetch, don't hash or save it
+        content_type = response.headers.get('Content-Type', '').lower()
+        if not content_type.startswith('image/'):
+            response.close()
+            logger.error("Error downloading image %d: unexpected content type '%s'", i, content_type)
+            return False
+
+        # The same ETag means the same image was served again, skip it before reading the body
+        etag = response.headers.get('ETag')
+        if etag and etag in etag_cache:
+            response.close()
+            logger.info("Skipped image %d: duplicate of an already downloaded image", i)
+            return False
+
+        # The final name depends on the content hash, so all work happens on a temporary file and the
+        # final name is only published once the image is complete
+        tmp_path = f"{output_prefix}download_{i}.part"
+
+        out_file = open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE)  # Outside the try, a failed open has nothing to clean up
+        claimed = False
+        try:
+            # Hash and write in a single pass over the body, the response can only be consumed once
+            hasher = hashlib.sha256()
+            response.raw.decode_content = True  # Still undo any transfer encoding the server applies
+            with out_file:
+                hash_and_write(response.raw, out_file, hasher)
+
+            content_hash = hasher.hexdigest()
+            # Named after the SHA-256 of the body as downloaded. The EXIF rewrite below changes the
+            # bytes on disk but not the name, so the name is what identifies the image in later runs.
+            file_path = f"{output_prefix}{content_hash}.webp"  # Force .webp whatever the content type
+            # Check and claim the hash atomically, otherwise two workers fetching the same image both keep it.
+            # Images from previous runs are found by name, there's no index of them to load.
+            with hashes_lock:
+                claimed = content_hash not in claimed_hashes and not os.path.exists(file_path)
+                if claimed:
+                    claimed_hashes.add(content_hash)
+                elif etag:
+                    etag_cache[etag] = content_hash  # Already saved, skip this ETag at header time from now on
+
+            if not claimed:
+                os.unlink(tmp_path)
+                logger.info("Skipped image %d: duplicate of an already downloaded image", i)
+                return False
+
+            # Add EXIF copyright and software data, keep the image without them if that fails
+            try:
+                tagged_image = encode_with_exif(tmp_path, image_url)
+            except Exception as e:
+                logger.warning("Error adding EXIF data to %s: %s", file_path, e)
+            else:
+                with open(tmp_path, 'wb') as out_file:
+                    out_file.write(tagged_image)
 
+            os.replace(tmp_path, file_path)  # Atomic rename, the final name only ever holds a complete image
+        except BaseException:
+            if claimed:
+                with hashes_lock:
+                    claimed_hashes.discard(content_hash)  # Nothing was saved, let a later download retry it
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)  # Don't leave partial downloads behind
+            raise
 
+        with hashes_lock:
+            if etag:
+                etag_cache[etag] = content_hash  # Only once the image is saved, a failed save must not mark it as seen
 
-        except Exception as e:
-            print(f"Error adding EXIF data to {file_path}: {e}")
+        logger.info("Downloaded image %d to %s", i, file_path)
 
         return True  # Indicate success
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading image {i}: {e}")
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:  # Body reads from response.raw raise urllib3 errors
+        logger.error("Error downloading image %d: %s", i, e)
         return False  # Indicate failure
     except Exception as e:
-        print(f"An unexpected error occurred while processing image {i}: {e}")
+        logger.error("An unexpected error occurred while processing image %d: %s", i, e)
         return False  # Indicate failure
 
 
-def download_picre_varied_images_resume(num_images, max_threads=4):  # Added max_threads argument
+def download_picre_varied_images_resume(num_images, max_threads=4, requests_per_second=5):  # Added max_threads argument
     """
-    Downloads multiple versions of the image from pic.re/image, resuming
-    from the last downloaded image in the 'picre_varied_images' folder within
-    your Documents directory, using multithreading for faster download speeds.
+    Downloads multiple versions of the image from pic.re/image into the
+    'picre_varied_images' folder within your Documents directory, skipping
+    images that are already there, using multithreading for faster download speeds.
+
+    Duplicates are recognised by the <sha256>.webp name given at download
+    time. Images saved by older versions (image_<n>.webp) were rewritten
+    with EXIF data and their original hash is lost, so they are left
+    untouched and not checked for duplicates.
 
     Args:
-        num_images (int): The number of different image versions to download
-                         (including the resumed ones).
+        num_images (int): The number of image versions to download, duplicates
+                         of already downloaded images are skipped.
         max_threads (int): The maximum number of threads to use for downloading.
+        requests_per_second (float): The maximum number of requests sent to
+                                     pic.re per second, shared by all threads.
+                                     Must be positive.
     """
 
     # Get the path to the Documents directory
@@ -103,47 +216,46 @@ def download_picre_varied_images_resume(num_images, max_threads=4):  # Added max
 
     # Create the 'picre_varied_images' folder if it doesn't exist
     output_folder = os.path.join(documents_path, "picre_varied_images")
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    output_prefix = output_folder + os.sep  # Joined once, workers just append the filename
 
     image_url = "https://pic.re/image"  # The single, unchanging URL
 
-    # Determine the starting index by checking existing files
-    existing_files = [f for f in os.listdir(output_folder) if f.startswith("image_") and f.endswith(".webp")]
-    if existing_files:
-        # Extract the numbers from filenames, handle cases where other file types are present
-        existing_indices = []
-        for filename in existing_files:
-            try:
-                index = int(filename.split('_')[1].split('.')[0])
-                existing_indices.append(index)
-            except (IndexError, ValueError):
-                print(f"Warning: Could not parse index from existing filename: {filename}")
+    # Remove partial downloads left behind by a killed run, they're never resumed.
+    # Only one run at a time should use the folder, this would also delete another run's files in progress.
+    with os.scandir(output_folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(".part"):
+                os.unlink(entry.path)
 
-        if existing_indices:
-            start_index = max(existing_indices) + 1
-        else:
-            start_index = 1  # if files are named incorrectly, start from 1
-    else:
-        start_index = 1  # Start from 1 if the folder is empty
-
-    print(f"Resuming download from image_{start_index}.webp")
+    claimed_hashes = set()  # Hashes of the images saved during this run
+    hashes_lock = threading.Lock()
+    etag_cache = {}  # ETag -> SHA-256 of the image served with it
+    bucket = TokenBucket(requests_per_second)
 
     # Use a thread pool to download images concurrently
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = [executor.submit(download_image, image_url, output_folder, i)
-                   for i in range(start_index, start_index + num_images)]
+        # Keep at most 2 * max_threads downloads queued, so memory doesn't grow with num_images
+        max_pending = 2 * max_threads
+        pending = set()
+        for i in range(1, num_images + 1):
+            pending.add(executor.submit(download_image, image_url, output_prefix, i, claimed_hashes, etag_cache, hashes_lock, bucket))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # Surface anything download_image didn't handle itself
 
-        # Wait for all downloads to complete (or timeout)
-        concurrent.futures.wait(futures)
+        # Wait for the remaining downloads to complete
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
 
-    print("Download complete.")
+    logger.info("Download complete.")
 
 
 if __name__ == "__main__":
     while True:
         try:
-            count = int(input("Enter the total number of images to download (including resumed ones): "))
+            count = int(input("Enter the number of images to download: "))
             break  # Exit loop if input is valid
         except ValueError:
             print("Invalid input. Please enter an integer.")
@@ -159,5 +271,24 @@ if __name__ == "__main__":
         except ValueError:
             print("Invalid input. Please enter an integer.")
 
-    download_picre_varied_images_resume(count, num_threads) # Pass the thread count
+    # Ask for the request rate limit
+    while True:
+        try:
+            rate = float(input("Enter the maximum number of requests per second (default is 5, higher values can overwhelm the server): "))
+            if rate > 0:
+                break
+            else:
+                print("Request rate must be positive.")
+        except ValueError:
+            print("Invalid input. Please enter a number.")
+
+    # Workers only enqueue log records, a background listener thread does the actual writes to stdout
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    try:
+        download_picre_varied_images_resume(count, num_threads, rate) # Pass the thread count and rate limit
+    finally:
+        listener.stop()  # Flushes the remaining records
     print("Download complete.")